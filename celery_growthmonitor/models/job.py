@@ -4,21 +4,29 @@ import logging
 import os
 import random as rnd
 import re
+import shutil
 from datetime import datetime
-from distutils.version import StrictVersion
 from enum import unique
 
-from django import get_version as django_version
+from autoslugged import AutoSlugField
+from django import VERSION as DJANGO_VERSION
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
 from django.core.validators import RegexValidator
 from django.db import models
 from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
+from echoices.enums import EChoice
+from echoices.fields import make_echoicefield
 
 from .. import settings
 
 logger = logging.getLogger(__name__)
 TEMPORARY_JOB_FOLDER = 'tmp'
+_DJANGO_LT_110 = DJANGO_VERSION[:2] < (1, 10)
+_TMP_ID_LO, _TMP_ID_HI = 10 ** 6, 10 ** 7
+_TMP_ID_RANGE = _TMP_ID_HI - _TMP_ID_LO
 
 
 def job_root(instance, filename=''):
@@ -37,19 +45,38 @@ def job_root(instance, filename=''):
     str
         Path to the root folder for that job
     """
-    if instance.root_job:
-        if callable(instance.root_job):
-            return os.path.join(settings.APP_MEDIA_ROOT, instance.root_job())
-        else:
-            head = str(instance.root_job)
+    root_job = instance.root_job
+    if callable(root_job):
+        # May depend on any field of the job, hence cannot be memoized
+        root = os.path.join(settings.APP_MEDIA_ROOT, root_job())
+        return os.path.join(root, filename) if filename else root
+    # Plain instance attributes, no need to go through getattr()
+    attrs = instance.__dict__
+    iid = instance.id
+    tmp_id = attrs.get('_tmp_id')
+    use_tmp = not iid or bool(tmp_id and not attrs.get('_tmp_files'))
+    key = (iid, tmp_id, use_tmp, root_job, settings.APP_MEDIA_ROOT)
+    cache = attrs.get('_root_job_cache')
+    if cache and cache[0] == key:
+        root = cache[1]
     else:
-        head = instance.__class__.__name__.lower()
-    if not instance.id or (
-                    instance.id and getattr(instance, '_tmp_id', None) and not getattr(instance, '_tmp_files', None)):
-        tail = os.path.join(TEMPORARY_JOB_FOLDER, str(getattr(instance, '_tmp_id')))
+        root = _job_root(instance, use_tmp)
+        # Memoize, as this is resolved once per file of the job
+        instance._root_job_cache = (key, root)
+    return os.path.join(root, filename) if filename else root
+
+
+def _job_root(instance, use_tmp):
+    """
+    Compute the path to the root folder of the job `instance` when `root_job` is not callable, see `job_root`.
+    """
+    if instance.root_job:
+        head = str(instance.root_job)
     else:
-        tail = str(instance.id)
-    return os.path.join(settings.APP_MEDIA_ROOT, head, tail, filename)
+        head = instance._default_job_folder
+    if use_tmp:
+        return os.path.join(settings.APP_MEDIA_ROOT, head, instance._tmp_tail)
+    return os.path.join(settings.APP_MEDIA_ROOT, head, str(instance.id))
 
 
 def job_data(instance, filename=''):
@@ -69,9 +96,7 @@ def job_data(instance, filename=''):
         Path to filename which is unique for a job
     """
     job = instance if isinstance(instance, AJob) else instance.job
-    head = job.upload_to_root()
-    tail = os.path.join('data', filename)
-    return os.path.join(head, tail)
+    return os.path.join(job.upload_to_root(), 'data', filename)
 
 
 def job_results(instance, filename=''):
@@ -91,9 +116,7 @@ def job_results(instance, filename=''):
         Path to filename which is unique for a job
     """
     job = instance if isinstance(instance, AJob) else instance.job
-    head = job.upload_to_root()
-    tail = os.path.join('results', filename)
-    return os.path.join(head, tail)
+    return os.path.join(job.upload_to_root(), 'results', filename)
 
 
 def get_upload_to_path(instance, callable_or_prefix, filename=''):
@@ -152,10 +175,6 @@ class AJob(models.Model):
     http://stackoverflow.com/questions/16655097/django-abstract-models-versus-regular-inheritance#16838663
     """
 
-    from autoslugged import AutoSlugField
-    from echoices.enums import EChoice
-    from echoices.fields import make_echoicefield
-
     class Meta:
         abstract = True
 
@@ -179,11 +198,13 @@ class AJob(models.Model):
     IDENTIFIER_MIN_LENGTH = 0
     IDENTIFIER_MAX_LENGTH = 32
     IDENTIFIER_ALLOWED_CHARS = "[a-zA-Z0-9]"
-    IDENTIFIER_REGEX = re.compile("{}{{{},}}".format(IDENTIFIER_ALLOWED_CHARS, IDENTIFIER_MIN_LENGTH))
+    IDENTIFIER_REGEX = re.compile(r"\A{}{{{},{}}}\Z".format(IDENTIFIER_ALLOWED_CHARS, IDENTIFIER_MIN_LENGTH,
+                                                           IDENTIFIER_MAX_LENGTH))
     SLUG_MAX_LENGTH = 32
     SLUG_RND_LENGTH = 6
 
     REQUIRED_USER_FILES_ATTRNAME = 'required_user_files'
+    required_user_files = ()
 
     root_job = None
     upload_to_root = job_root
@@ -191,13 +212,14 @@ class AJob(models.Model):
 
     def slug_default(self):
         if self.identifier:
-            slug = self.identifier[:min(len(self.identifier), self.SLUG_RND_LENGTH)]
+            slug = self.identifier[:self.SLUG_RND_LENGTH]
         else:
             slug = self.__class__.__name__[0]
-        slug += self.timestamp.strftime("%y%m%d%H%M")  # YYMMDDHHmm
+        t = self.timestamp
+        slug += "{:02d}{:02d}{:02d}{:02d}{:02d}".format(t.year % 100, t.month, t.day, t.hour, t.minute)  # YYMMDDHHmm
         if len(slug) > self.SLUG_MAX_LENGTH:
             slug = slug[:self.SLUG_MAX_LENGTH - self.SLUG_RND_LENGTH] + \
-                   str(rnd.randrange(10 ** (self.SLUG_RND_LENGTH - 1), 10 ** self.SLUG_RND_LENGTH))
+                   str(self._slug_rnd_lo + rnd.getrandbits(64) % self._slug_rnd_range)
         # TODO: assert uniqueness, otherwise regen
         return slug
 
@@ -231,54 +253,112 @@ class AJob(models.Model):
     def __str__(self):
         return str('{} {} ({} and {})'.format(self.__class__.__name__, self.id, self.state.label, self.status.label))
 
+    def _get_required_user_attnames(self):
+        """
+        Attribute names of the required user files, resolved once per class unless overridden on the instance.
+
+        Returns
+        -------
+        tuple of str
+
+        """
+        if self.REQUIRED_USER_FILES_ATTRNAME in self.__dict__:
+            return _resolve_attnames(self.__dict__[self.REQUIRED_USER_FILES_ATTRNAME])
+        return self._required_user_attnames
+
     def _move_data_from_tmp_to_upload(self):
         # https://stackoverflow.com/a/16574947/
         # TODO: assert required_user_files is not empty? --> user warning?
-        setattr(self, '_tmp_files', list(getattr(self, self.REQUIRED_USER_FILES_ATTRNAME)))
-        for field in getattr(self, self.REQUIRED_USER_FILES_ATTRNAME):
-            file = getattr(self, field) if isinstance(field, str) else getattr(self, field.attname)
+        attnames = self._get_required_user_attnames()
+        tmp_root = self.upload_to_root()
+        # With a callable `root_job`, the files were directly uploaded to their final root folder
+        use_tmp = not callable(self.root_job) and bool(getattr(self, '_tmp_tail', None))
+        setattr(self, '_tmp_files', set(attnames))
+        # Temporary folders on the filesystem, and their roots, to be removed once emptied
+        tmp_folders = set()
+        tmp_roots = set()
+        for attname in attnames:
+            file = getattr(self, attname)
             if not file:
-                raise FileNotFoundError("{} is indicated as required, but no file could be found".format(field))
+                raise FileNotFoundError("{} is indicated as required, but no file could be found".format(attname))
             # Create new filename, using primary key and file extension
             old_filename = file.name
             new_filename = file.field.upload_to(self, os.path.basename(old_filename))
             # TODO: try this instead: https://docs.djangoproject.com/en/1.11/topics/files/#using-files-in-models
-            # Create new file and remove old one
-            file.storage.save(new_filename, file)
-            file.name = new_filename
-            file.close()
-            file.storage.delete(old_filename)
-            getattr(self, '_tmp_files').remove(field)
-        import shutil
-        shutil.rmtree(get_absolute_path(self, self.upload_to_root))
+            if isinstance(file.storage, FileSystemStorage):
+                if use_tmp:
+                    storage_tmp_root = file.storage.path(tmp_root)
+                    old_folder = os.path.dirname(file.storage.path(old_filename))
+                    if os.path.commonpath([storage_tmp_root, old_folder]) == storage_tmp_root:
+                        tmp_folders.add(old_folder)
+                    tmp_roots.add(storage_tmp_root)
+            # __class__ resolves lazy storages such as default_storage, subclasses may customise how files are saved
+            if file.storage.__class__ is FileSystemStorage:
+                # Move the file on disk instead of copying its content
+                new_filename = file.storage.get_available_name(new_filename, max_length=file.field.max_length)
+                new_path = file.storage.path(new_filename)
+                _makedirs(file.storage, os.path.dirname(new_path))
+                file.close()
+                file_move_safe(file.storage.path(old_filename), new_path)
+                file.name = new_filename
+            else:
+                # Create new file and remove old one
+                with file.storage.open(old_filename) as content:
+                    new_filename = file.storage.save(new_filename, content)
+                file.name = new_filename
+                file.close()
+                file.storage.delete(old_filename)
+            getattr(self, '_tmp_files').discard(attname)
+        setattr(self, '_tmp_files', frozenset())
+        # All the files have been moved, only empty folders should remain
+        for folder in sorted(tmp_folders - tmp_roots, reverse=True) + sorted(tmp_roots):
+            try:
+                os.rmdir(folder)
+            except FileNotFoundError:
+                pass  # Already cleaned up
+            except OSError as ose:
+                logger.warning("Could not remove the temporary folder of %s (%s), removing it recursively", self, ose)
+                for tmp_folder in tmp_roots:
+                    shutil.rmtree(tmp_folder, ignore_errors=True)
+                break
         setattr(self, '_tmp_id', 0)
+        self._root_job_cache = None
 
     def save(self, *args, results_exist_ok=False, **kwargs):
         created = not self.pk
-        if created and getattr(self, 'required_user_files', []):
+        if created and settings.TTL.seconds > 0:
+            # Set timeout before the first INSERT so that it is written along
+            self.timestamp = self.timestamp or timezone.now()
+            self.closure = self.timestamp + settings.TTL
+        if created and self._get_required_user_attnames():
             setattr(self, 'upload_to_data', getattr(self, 'upload_to_data', None))
-            setattr(self, '_tmp_id', rnd.randrange(10 ** 6, 10 ** 7))
+            setattr(self, '_tmp_id', _TMP_ID_LO + rnd.getrandbits(64) % _TMP_ID_RANGE)
+            setattr(self, '_tmp_tail', os.path.join(TEMPORARY_JOB_FOLDER, str(self._tmp_id)))
         try:
             super(AJob, self).save(*args, **kwargs)  # Call the "real" save() method.
         except AttributeError as ae:
-            if "object has no attribute '_tmp_id'" in str(ae.args):
+            if "object has no attribute '_tmp_tail'" in str(ae.args):
                 raise AttributeError(
                     "It looks like you forgot to set the `required_user_files` attribute on {}.".format(
                         self.__class__)) from None
             raise ae
         if created:
-            dirty = False
-            if settings.TTL.seconds > 0:
-                # Set timeout
-                self.closure = self.timestamp + settings.TTL
-                dirty = True  # Write closure to DB
-            if getattr(self, 'required_user_files', []):
-                self._move_data_from_tmp_to_upload()
-                dirty = True  # Persist file changes
-            if dirty:
-                super(AJob, self).save()
+            self._root_job_cache = None  # The primary key is now known
             # Ensure the destination folder exists (may create some issues else, depending on application usage)
-            os.makedirs(get_absolute_path(self, self.upload_to_results), exist_ok=results_exist_ok)
+            if self._get_required_user_attnames():
+                self._move_data_from_tmp_to_upload()
+                super(AJob, self).save()  # Persist file changes
+                results = get_absolute_path(self, self.upload_to_results)
+                try:
+                    # The job folder has most likely been created while moving the files
+                    os.mkdir(results)
+                except FileNotFoundError:
+                    os.makedirs(results, exist_ok=results_exist_ok)
+                except FileExistsError:
+                    if not (results_exist_ok and os.path.isdir(results)):
+                        raise
+            else:
+                os.makedirs(get_absolute_path(self, self.upload_to_results), exist_ok=results_exist_ok)
 
     def progress(self, new_state):
         """
@@ -378,7 +458,7 @@ class ADataFile(models.Model):
     job = None  # Just a placeholder for IDEs
     data = None  # Just a placeholder for IDEs
 
-    if StrictVersion(django_version()) < StrictVersion('1.10.0'):
+    if _DJANGO_LT_110:
         # SEE: https://docs.djangoproject.com/en/1.10/topics/db/models/#field-name-hiding-is-not-permitted
         job = None  # Just a placeholder, Django < 1.10 does not support overriding Fields of abstract models
         data = None  # Just a placeholder, Django  < 1.10 does not support overriding Fields of abstract models
@@ -387,6 +467,52 @@ class ADataFile(models.Model):
         data = models.FileField(upload_to=upload_to_data, max_length=256)
 
 
+def _makedirs(storage, directory):
+    """
+    Create `directory` and its parents like `FileSystemStorage` does, i.e. honouring its permissions mode.
+
+    Mirrors the base `FileSystemStorage._save` only, customisations of its subclasses are not applied.
+
+    Parameters
+    ----------
+    storage : FileSystemStorage
+    directory : str
+
+    """
+    if storage.directory_permissions_mode is not None:
+        # os.makedirs only applies the mode to the leaf, the umask covers the intermediate folders
+        old_umask = os.umask(0o777 & ~storage.directory_permissions_mode)
+        try:
+            os.makedirs(directory, storage.directory_permissions_mode, exist_ok=True)
+        finally:
+            os.umask(old_umask)
+    else:
+        os.makedirs(directory, exist_ok=True)
+
+
+def _resolve_attnames(fields):
+    return tuple(field if isinstance(field, str) else field.attname for field in fields)
+
+
+@receiver(models.signals.class_prepared, )
+def _prepare_job_class(sender, **kwargs):
+    """
+    Precompute class-wide values of a job: its default root folder, the bounds of the random slug suffix and the
+    attribute names of its required user files.
+
+    Parameters
+    ----------
+    sender
+    kwargs
+
+    """
+    if issubclass(sender, AJob):
+        sender._default_job_folder = sender.__name__.lower()
+        sender._slug_rnd_lo = 10 ** (sender.SLUG_RND_LENGTH - 1)
+        sender._slug_rnd_range = 10 ** sender.SLUG_RND_LENGTH - sender._slug_rnd_lo
+        sender._required_user_attnames = _resolve_attnames(getattr(sender, sender.REQUIRED_USER_FILES_ATTRNAME, ()))
+
+
 @receiver(models.signals.post_delete, )
 def _autoremove_files(sender, instance, *args, **kwargs):
     """
@@ -401,12 +527,9 @@ def _autoremove_files(sender, instance, *args, **kwargs):
 
     """
     if issubclass(sender, AJob):
-        if hasattr(instance, instance.REQUIRED_USER_FILES_ATTRNAME):
-            for field in getattr(instance, instance.REQUIRED_USER_FILES_ATTRNAME):
-                file = getattr(instance, field) if isinstance(field, str) else getattr(instance, field.attname)
-                file.delete(save=False)
+        for attname in instance._get_required_user_attnames():
+            getattr(instance, attname).delete(save=False)
         # Delete all remaining files stored on the filesystem
-        import shutil
         shutil.rmtree(get_absolute_path(instance, instance.upload_to_root))
     elif issubclass(sender, ADataFile):
         instance.data.delete(save=False)
@@ -1,6 +1,10 @@
+import os
 from distutils.version import StrictVersion
 
 from django import get_version as django_version
+from django.conf import settings as django_settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, Storage
 from django.db import models
 
 from celery_growthmonitor.models import AJob, ADataFile, job_root, job_data, job_results
@@ -27,6 +31,15 @@ class MyRootFuncTestJob(AJob):
     root_job = my_job_root
 
 
+def my_dynamic_job_root(instance):
+    import os
+    return os.path.join('my_root_dyn', instance.identifier)
+
+
+class MyRootDynamicTestJob(AJob):
+    root_job = my_dynamic_job_root
+
+
 class MyResultsStrTestJob(AJob):
     upload_to_results = 'my_results_str'
 
@@ -104,3 +117,78 @@ class TestJobWithRequiredFile(AJob):
     other = models.FileField(upload_to=job_data, max_length=256)
 
     required_user_files = ['sample', other]
+
+
+class MyRootFuncTestJobWithRequiredFile(AJob):
+    root_job = my_job_root
+    sample = models.FileField(upload_to=job_data, max_length=256)
+
+    required_user_files = ['sample']
+
+
+class TestJobWithOptionalFile(AJob):
+    sample = models.FileField(upload_to=job_data, max_length=256)
+
+
+class MemoryStorage(Storage):
+    """
+    Minimal non-filesystem storage.
+    """
+
+    def __init__(self):
+        self.files = {}
+
+    def _open(self, name, mode='rb'):
+        return ContentFile(self.files[name], name=name)
+
+    def _save(self, name, content):
+        self.files[name] = content.read()
+        return name
+
+    def delete(self, name):
+        self.files.pop(name, None)
+
+    def exists(self, name):
+        return name in self.files
+
+
+memory_storage = MemoryStorage()
+
+
+class TestJobWithRequiredMemoryFile(AJob):
+    sample = models.FileField(upload_to=job_data, max_length=256, storage=memory_storage)
+
+    required_user_files = ['sample']
+
+
+other_location_storage = FileSystemStorage(location=os.path.join(django_settings.MEDIA_ROOT, os.pardir, 'other_media'))
+
+
+class TestJobWithRequiredOtherLocationFile(AJob):
+    sample = models.FileField(upload_to=job_data, max_length=256, storage=other_location_storage)
+
+    required_user_files = ['sample']
+
+
+class RecordingStorage(FileSystemStorage):
+    """
+    Filesystem storage keeping track of the files it saves.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(RecordingStorage, self).__init__(*args, **kwargs)
+        self.saved = []
+
+    def _save(self, name, content):
+        name = super(RecordingStorage, self)._save(name, content)
+        self.saved.append(name)
+        return name
+
+
+recording_storage = RecordingStorage()
+
+
+class TestJobWithRequiredRecordedFile(AJob):
+    sample = models.FileField(upload_to=job_data, max_length=256, storage=recording_storage)
+
+    required_user_files = ['sample']
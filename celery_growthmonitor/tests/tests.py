@@ -36,6 +36,21 @@ class JobTestCase(TestCase):
                                      RuntimeWarning, 'DateTimeField TestJob.closure received a naive datetime',
                                      test_job.save)
 
+    def test_closure(self):
+        from datetime import timedelta
+        from unittest import mock
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        ttl = timedelta(hours=1)
+        with mock.patch.object(settings, 'TTL', ttl), CaptureQueriesContext(connection) as queries:
+            test_job = models.TestJob()
+            test_job.save()
+        statements = [query['sql'].split(None, 1)[0].upper() for query in queries.captured_queries]
+        self.assertEqual(statements.count('INSERT'), 1)
+        self.assertNotIn('UPDATE', statements)
+        test_job.refresh_from_db()
+        self.assertAlmostEqual(test_job.closure, test_job.timestamp + ttl, delta=timedelta(seconds=1))
+
     def test_job(self):
         # Base case
         expected_path = self.build_path('testjob', '1', 'results')
@@ -80,6 +95,39 @@ class JobTestCase(TestCase):
         test_job.save()
         self.assertTrue(os.path.isdir(expected_path))
 
+    def test_job_root_cache(self):
+        from unittest import mock
+        move_data = AJob._move_data_from_tmp_to_upload
+        caches = []
+
+        def spy(job):
+            caches.append(job._root_job_cache)
+            move_data(job)
+            caches.append(job._root_job_cache)
+
+        test_job = models.TestJobWithRequiredFile(sample=ContentFile('SAMPLE DUMMY CONTENT', 'sample.txt'),
+                                                  other=ContentFile('OTHER DUMMY CONTENT', 'other.txt'))
+        with mock.patch.object(AJob, '_move_data_from_tmp_to_upload', spy):
+            test_job.save()
+        # Dropped once the primary key is known, then once the temporary id is reset
+        self.assertEqual(caches, [None, None])
+        expected_root = os.path.join(settings.APP_MEDIA_ROOT, 'testjobwithrequiredfile', '1')
+        self.assertEqual(test_job.upload_to_root('sample.txt'), os.path.join(expected_root, 'sample.txt'))
+        self.assertEqual(test_job._root_job_cache[1], expected_root)
+        # A root set on the instance afterwards is taken into account
+        test_job.root_job = 'my_root_str'
+        self.assertEqual(test_job.upload_to_root('sample.txt'),
+                         os.path.join(settings.APP_MEDIA_ROOT, 'my_root_str', '1', 'sample.txt'))
+        #
+        # A callable root_job is not memoized
+        test_job = models.MyRootDynamicTestJob(identifier='a')
+        test_job.save()
+        self.assertEqual(test_job.upload_to_root('sample.txt'),
+                         os.path.join(settings.APP_MEDIA_ROOT, 'my_root_dyn', 'a', 'sample.txt'))
+        test_job.identifier = 'b'
+        self.assertEqual(test_job.upload_to_root('sample.txt'),
+                         os.path.join(settings.APP_MEDIA_ROOT, 'my_root_dyn', 'b', 'sample.txt'))
+
     def test_job_with_data_file(self):
         test_file = ContentFile('DUMMY CONTENT', 'foobar.txt')
         # Base case
@@ -138,6 +186,8 @@ class JobTestCase(TestCase):
         # TODO: tests with my_results_func
 
     def test_job_with_user_required_file(self):
+        from unittest import mock
+        from django.core.files.move import file_move_safe
         sample_file = ContentFile('SAMPLE DUMMY CONTENT', 'sample.txt')
         other_file = ContentFile('OTHER DUMMY CONTENT', 'other.txt')
         # Base case
@@ -146,7 +196,10 @@ class JobTestCase(TestCase):
         self.assertFalse(os.path.exists(expected_sample_path))
         self.assertFalse(os.path.exists(expected_other_path))
         test_job = models.TestJobWithRequiredFile(sample=sample_file, other=other_file)
-        test_job.save()
+        with mock.patch('celery_growthmonitor.models.job.file_move_safe', wraps=file_move_safe) as move:
+            test_job.save()
+        # The default storage is a plain filesystem storage, the files are moved on disk
+        self.assertEqual(move.call_count, 2)
         self.assertTrue(os.path.exists(expected_sample_path))
         self.assertTrue(os.path.exists(expected_other_path))
         # TODO: test file path in test_job
@@ -157,6 +210,134 @@ class JobTestCase(TestCase):
         self.assertFalse(os.path.exists(self.build_path('testjobwithrequiredfile', '1')))
         self.assertTrue(os.path.exists(self.build_path('testjobwithrequiredfile')))
 
+    def test_job_with_user_required_file_collision(self):
+        from unittest import mock
+        from django.core.files.move import file_move_safe
+        existing_path = self.build_path('testjobwithrequiredfile', '1', 'data', 'sample.txt')
+        os.makedirs(os.path.dirname(existing_path))
+        with open(existing_path, 'w') as existing:
+            existing.write('EXISTING DUMMY CONTENT')
+        test_job = models.TestJobWithRequiredFile(sample=ContentFile('SAMPLE DUMMY CONTENT', 'sample.txt'),
+                                                  other=ContentFile('OTHER DUMMY CONTENT', 'other.txt'))
+        with mock.patch('celery_growthmonitor.models.job.file_move_safe', wraps=file_move_safe) as move:
+            test_job.save()
+        move.assert_any_call(mock.ANY, test_job.sample.path)
+        # The existing file is left untouched, the moved one is renamed
+        with open(existing_path) as existing:
+            self.assertEqual(existing.read(), 'EXISTING DUMMY CONTENT')
+        self.assertNotEqual(test_job.sample.path, existing_path)
+        self.assertEqual(os.path.dirname(test_job.sample.path), os.path.dirname(existing_path))
+        with open(test_job.sample.path) as sample:
+            self.assertEqual(sample.read(), 'SAMPLE DUMMY CONTENT')
+
+    def test_job_with_user_required_file_permissions(self):
+        from unittest import mock
+        from django.test import override_settings
+        from ..models import job
+        with override_settings(FILE_UPLOAD_DIRECTORY_PERMISSIONS=0o750), \
+                mock.patch.object(job, '_makedirs', wraps=job._makedirs) as makedirs:
+            test_job = models.TestJobWithRequiredFile(sample=ContentFile('SAMPLE DUMMY CONTENT', 'sample.txt'),
+                                                      other=ContentFile('OTHER DUMMY CONTENT', 'other.txt'))
+            test_job.save()
+        # The job folders are created while moving the files
+        makedirs.assert_any_call(mock.ANY, self.build_path('testjobwithrequiredfile', '1', 'data'))
+        self.assertEqual(os.stat(self.build_path('testjobwithrequiredfile', '1')).st_mode & 0o777, 0o750)
+        self.assertEqual(os.stat(self.build_path('testjobwithrequiredfile', '1', 'data')).st_mode & 0o777, 0o750)
+
+    def test_job_with_user_required_file_other_storage(self):
+        self.addCleanup(models.memory_storage.files.clear)
+        test_job = models.TestJobWithRequiredMemoryFile(sample=ContentFile('SAMPLE DUMMY CONTENT', 'sample.txt'))
+        test_job.save()
+        expected_name = os.path.join(settings.APP_MEDIA_ROOT, 'testjobwithrequiredmemoryfile', '1', 'data',
+                                     'sample.txt')
+        self.assertEqual(test_job.sample.name, expected_name)
+        self.assertEqual(list(models.memory_storage.files), [expected_name])
+        self.assertEqual(models.memory_storage.files[expected_name], 'SAMPLE DUMMY CONTENT')
+
+    def test_job_with_user_required_file_other_location(self):
+        import shutil
+        from unittest import mock
+        storage = models.other_location_storage
+        self.addCleanup(shutil.rmtree, storage.location, ignore_errors=True)
+        test_job = models.TestJobWithRequiredOtherLocationFile(sample=ContentFile('SAMPLE DUMMY CONTENT',
+                                                                                  'sample.txt'))
+        with mock.patch('celery_growthmonitor.models.job.logger') as logger:
+            test_job.save()
+        logger.warning.assert_not_called()  # No fallback to a recursive removal
+        self.assertTrue(os.path.isfile(storage.path(
+            os.path.join(settings.APP_MEDIA_ROOT, 'testjobwithrequiredotherlocationfile', '1', 'data', 'sample.txt'))))
+        self.assertEqual(os.listdir(storage.path(
+            os.path.join(settings.APP_MEDIA_ROOT, 'testjobwithrequiredotherlocationfile', 'tmp'))), [])
+
+    def test_job_with_user_required_file_storage_subclass(self):
+        storage = models.recording_storage
+        self.addCleanup(storage.saved.clear)
+        test_job = models.TestJobWithRequiredRecordedFile(sample=ContentFile('SAMPLE DUMMY CONTENT', 'sample.txt'))
+        test_job.save()
+        # The file is saved through the storage of the subclass, not moved on disk
+        expected_name = os.path.join(settings.APP_MEDIA_ROOT, 'testjobwithrequiredrecordedfile', '1', 'data',
+                                     'sample.txt')
+        self.assertEqual(test_job.sample.name, expected_name)
+        self.assertEqual(storage.saved[-1], expected_name)
+        self.assertTrue(os.path.isfile(self.build_path('testjobwithrequiredrecordedfile', '1', 'data', 'sample.txt')))
+        self.assertEqual(os.listdir(self.build_path('testjobwithrequiredrecordedfile', 'tmp')), [])
+
+    def test_job_with_user_required_file_cleanup_fallback(self):
+        from unittest import mock
+        # Leave a stray file in the temporary folder the job will use
+        stray_path = self.build_path('testjobwithrequiredfile', 'tmp', str(10 ** 6), 'stray.txt')
+        os.makedirs(os.path.dirname(stray_path))
+        open(stray_path, 'w').close()
+        test_job = models.TestJobWithRequiredFile(sample=ContentFile('SAMPLE DUMMY CONTENT', 'sample.txt'),
+                                                  other=ContentFile('OTHER DUMMY CONTENT', 'other.txt'))
+        with mock.patch('celery_growthmonitor.models.job.rnd.getrandbits', return_value=0), \
+                self.assertLogs('celery_growthmonitor.models.job', 'WARNING'):
+            test_job.save()
+        self.assertEqual(os.listdir(self.build_path('testjobwithrequiredfile', 'tmp')), [])
+        self.assertTrue(os.path.isfile(self.build_path('testjobwithrequiredfile', '1', 'data', 'sample.txt')))
+
+    def test_job_with_user_required_file_copy(self):
+        from unittest import mock
+        test_job = models.TestJobWithRequiredFile(sample=ContentFile('SAMPLE DUMMY CONTENT', 'sample.txt'),
+                                                  other=ContentFile('OTHER DUMMY CONTENT', 'other.txt'))
+        test_job.save()
+        # Save as a copy, the files are not located in a temporary folder
+        test_job.pk = None
+        with mock.patch('celery_growthmonitor.models.job.logger') as logger:
+            test_job.save()
+        logger.warning.assert_not_called()
+        self.assertTrue(os.path.isfile(self.build_path('testjobwithrequiredfile', '2', 'data', 'sample.txt')))
+        self.assertTrue(os.path.isfile(self.build_path('testjobwithrequiredfile', '2', 'data', 'other.txt')))
+
+    def test_job_with_user_required_file_root_func(self):
+        from unittest import mock
+        test_job = models.MyRootFuncTestJobWithRequiredFile(sample=ContentFile('SAMPLE DUMMY CONTENT', 'sample.txt'))
+        with mock.patch('celery_growthmonitor.models.job.logger') as logger:
+            test_job.save()
+        logger.warning.assert_not_called()
+        self.assertTrue(os.path.isfile(self.build_path('my_root_func', '1', 'data', 'sample.txt')))
+
+    def test_job_with_instance_required_file(self):
+        expected_path = self.build_path('testjobwithoptionalfile', '1', 'data', 'sample.txt')
+        test_job = models.TestJobWithOptionalFile(sample=ContentFile('SAMPLE DUMMY CONTENT', 'sample.txt'))
+        test_job.required_user_files = ['sample']
+        test_job.save()
+        self.assertTrue(os.path.isfile(expected_path))
+        self.assertEqual(test_job.sample.name, os.path.join(settings.APP_MEDIA_ROOT, 'testjobwithoptionalfile', '1',
+                                                            'data', 'sample.txt'))
+        self.assertEqual(os.listdir(self.build_path('testjobwithoptionalfile', 'tmp')), [])
+
+
+class IdentifierTestCase(TestCase):
+    def test_identifier(self):
+        from django.core.exceptions import ValidationError
+        field = models.TestJob._meta.get_field('identifier')
+        field.run_validators('')
+        field.run_validators('MyJob42')
+        self.assertRaises(ValidationError, field.run_validators, 'my-job')
+        self.assertRaises(ValidationError, field.run_validators, 'my job')
+        self.assertRaises(ValidationError, field.run_validators, 'a' * (AJob.IDENTIFIER_MAX_LENGTH + 1))
+
 
 class TasksTestCase(TestCase):
     def setUp(self):